@@ -2,11 +2,16 @@ import yaml
 import argparse
 import os
 import datetime
-from dateutil.relativedelta import relativedelta
+import calendar
+import queue
+import functools
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from sentinelhub.geo_utils import bbox_to_dimensions
-from sentinelhub import SHConfig, SentinelHubRequest, BBox, CRS, DataCollection, MimeType, MosaickingOrder
-from PIL import Image, ImageEnhance
-import matplotlib.pyplot as plt
+from sentinelhub import SHConfig, SentinelHubRequest, SentinelHubDownloadClient, BBox, CRS, DataCollection, MimeType, MosaickingOrder
+from sentinelhub.exceptions import DownloadFailedException
+from PIL import Image
 
 # GLOBAL VARIABLES
 CONFIG_PATH = "config.yaml"
@@ -15,6 +20,11 @@ PROCESSED_DATA_FOLDER_256 = "processed_data_256/"
 BRIGHTNESS_FACTOR = 2.0
 GAMMA = 0.8
 RESOLUTION = 10
+MAX_DOWNLOAD_WORKERS = 5
+TILE_ROWS_PER_BLOCK = 2
+PNG_COMPRESS_LEVEL = 1
+TILE_QUEUE_SIZE = 4
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
 KAISHA_ISLAND_BOUNDING_BOX = BBox(bbox=[120.556068, 32.003272, 120.692711, 32.078502], crs=CRS.WGS84)
 KAISHA_SIZE = bbox_to_dimensions(KAISHA_ISLAND_BOUNDING_BOX, resolution=RESOLUTION)
 EVALSCRIPT_TRUE_COLOR = """
@@ -36,9 +46,11 @@ EVALSCRIPT_TRUE_COLOR = """
     }
 """
 
+@functools.lru_cache(maxsize=4)
 def load_cfg_file(cfg_path):
     """
     Load the configuration file. The config file contains the Sentinel Hub client ID and secret.
+    The configuration is cached, so loading the same path again returns the same object.
     :param cfg_path: path to the configuration file
     :return: configuration object
     """
@@ -56,38 +68,136 @@ def save_image_to_disk(image, output_path):
     :param image: image to save
     :param output_path: path to save the image
     """
+    # matplotlib is slow to import and only needed here, so import it lazily
+    import matplotlib.pyplot as plt
+
     plt.imsave(output_path, image)
     print(f"Image saved to {output_path}")
 
-def download_single_image(bbox, size, cfg, evalscript, time_interval=("2024-10-01", "2024-10-30")):
+def build_request_template(bbox, size, cfg, evalscript):
     """
-    Download a single image from Sentinel Hub
+    Build a template for Sentinel Hub requests that only differ in their input data
     :param bbox: bounding box of the AOI
-    :param resolution: resolution of the image in meters
+    :param size: size of the image in pixels
+    :param cfg: configuration object
     :param evalscript: evalscript to use for the request
-    :param time_interval: time interval for the request
-    :return: image
+    :return: function taking input_data and returning the request
     """
-
-    request = SentinelHubRequest(
+    return functools.partial(
+        SentinelHubRequest,
         evalscript=evalscript,
-        input_data=[
-            SentinelHubRequest.input_data(
-                data_collection=DataCollection.SENTINEL2_L1C,
-                time_interval=time_interval,
-                mosaicking_order=MosaickingOrder.LEAST_CC,
-            )
-        ],
         responses=[SentinelHubRequest.output_response("default", MimeType.PNG)],
         bbox=bbox,
         size=size,
         config=cfg,
     )
 
-    image = request.get_data()[0]
+def build_input_data(time_interval):
+    """
+    Build the input data of a request for a single image mosaicked by least CC
+    :param time_interval: time interval for the request
+    :return: input data
+    """
+    return [
+        SentinelHubRequest.input_data(
+            data_collection=DataCollection.SENTINEL2_L1C,
+            time_interval=time_interval,
+            mosaicking_order=MosaickingOrder.LEAST_CC,
+        )
+    ]
+
+def build_request(bbox, size, cfg, evalscript, time_interval):
+    """
+    Build a Sentinel Hub request for a single image mosaicked by least CC
+    :param bbox: bounding box of the AOI
+    :param size: size of the image in pixels
+    :param cfg: configuration object
+    :param evalscript: evalscript to use for the request
+    :param time_interval: time interval for the request
+    :return: request
+    """
+    return build_request_template(bbox, size, cfg, evalscript)(input_data=build_input_data(time_interval))
+
+def save_bytes_to_disk(data, output_path):
+    """
+    Save already encoded image bytes to disk
+    :param data: encoded image
+    :param output_path: path to save the image
+    """
+    # Write to a temporary file and move it into place, so an interrupted write never leaves
+    # a truncated image at output_path that a later run would take as already downloaded
+    part_path = output_path + ".part"
+    try:
+        with open(part_path, "wb") as file:
+            file.write(data)
+        os.replace(part_path, output_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    print(f"Image saved to {output_path}")
+
+def download_single_image(bbox, size, cfg, evalscript, time_interval=("2024-10-01", "2024-10-30"), client=None):
+    """
+    Download a single image from Sentinel Hub
+    :param bbox: bounding box of the AOI
+    :param resolution: resolution of the image in meters
+    :param evalscript: evalscript to use for the request
+    :param time_interval: time interval for the request
+    :param client: download client to use, a new client for cfg is created if not given
+    :return: image
+    """
+
+    if client is None:
+        client = SentinelHubDownloadClient(config=cfg)
+
+    request = build_request(bbox, size, cfg, evalscript, time_interval)
+    image = client.download(request.download_list, decode_data=True)[0]
     return image
 
-def download_images_to_disk(bbox, size, cfg, evalscript, time_interval=("2023-1-01", "2023-12-31"), output_dir=RAW_DATA_FOLDER):
+def add_months(date, months):
+    """
+    Add a number of months to a date, clamping the day to the length of the resulting month
+    :param date: date to shift
+    :param months: number of months to add
+    :return: shifted date
+    """
+    year, month = divmod(date.month - 1 + months, 12)
+    year += date.year
+    month += 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+def monthly_intervals(time_interval):
+    """
+    Split a time interval into consecutive one-month intervals
+    :param time_interval: time interval as a pair of "%Y-%m-%d" strings
+    :return: list of (start, end) pairs of "%Y-%m-%d" strings, the last one ends at the end of time_interval
+    """
+    start_date = datetime.datetime.strptime(time_interval[0], "%Y-%m-%d")
+    end_date = datetime.datetime.strptime(time_interval[1], "%Y-%m-%d")
+
+    months = []
+    index = 0
+    current_date = start_date
+    while current_date <= end_date:
+        next_date = add_months(start_date, index + 1)
+        month_end = min(next_date - datetime.timedelta(days=1), end_date)
+        months.append((current_date.strftime("%Y-%m-%d"), month_end.strftime("%Y-%m-%d")))
+        index += 1
+        current_date = next_date
+    return months
+
+def is_downloaded(output_path):
+    """
+    Check whether an image has already been saved to the given path. Images are moved into place
+    only once fully written, so an existing file is complete.
+    :param output_path: path of the image
+    :return: True if a non-empty file exists at the path
+    """
+    return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+
+def download_images_to_disk(bbox, size, cfg, evalscript, time_interval=("2023-1-01", "2023-12-31"), output_dir=RAW_DATA_FOLDER, max_workers=MAX_DOWNLOAD_WORKERS, force=False):
     """
     Download all images from Sentinel Hub in the given interval and save them to disk
     For each month, a single image mosaicked by least CC is downloaded
@@ -96,76 +206,207 @@ def download_images_to_disk(bbox, size, cfg, evalscript, time_interval=("2023-1-
     :param evalscript: evalscript to use for the request
     :param time_interval: time interval for the request
     :param output_dir: directory to save the images
+    :param max_workers: maximum number of months downloaded concurrently
+    :param force: download months whose image already exists in output_dir again
     """
 
     # Create the output directory if it does not exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    start_date = datetime.datetime.strptime(time_interval[0], "%Y-%m-%d")
-    end_date = datetime.datetime.strptime(time_interval[1], "%Y-%m-%d")
-    current_date = start_date
-
-    while current_date <= end_date:
-        month_end = current_date + relativedelta(months=1) - datetime.timedelta(days=1)
-        if month_end > end_date:
-            month_end = end_date
-        current_month = (current_date.strftime("%Y-%m-%d"), month_end.strftime("%Y-%m-%d"))
-        save_image_to_disk(download_single_image(bbox, size, cfg, evalscript, time_interval=current_month), f"{output_dir}/{current_month[0]}.png")
-        current_date += relativedelta(months=1)
+    months = monthly_intervals(time_interval)
+
+    # Skip months that were already downloaded by a previous run
+    if not force:
+        months = [current_month for current_month in months if not is_downloaded(f"{output_dir}/{current_month[0]}.png")]
+
+    # Submit all months as one batch so a single client (and its session/token) is reused.
+    # The thread limit keeps us within the Sentinel Hub fair-usage policy; 429 responses
+    # are retried by the client.
+    # Only the time interval changes between months, so the rest of the request is built once
+    request_template = build_request_template(bbox, size, cfg, evalscript)
+    requests = [request_template(input_data=build_input_data(current_month)) for current_month in months]
+    download_requests = [request.download_list[0] for request in requests]
+    # A month that still fails after retries must not discard the others, so failed downloads
+    # are returned as None instead of raising. The client reuses the cached session for cfg.
+    client = SentinelHubDownloadClient(config=cfg, raise_download_errors=False)
+    # The responses are already PNG encoded, so write them as they are instead of decoding and re-encoding
+    responses = client.download(download_requests, max_threads=max_workers, decode_data=False)
+
+    failed_months = []
+    for current_month, response in zip(months, responses):
+        if response is None:
+            failed_months.append(current_month)
+            continue
+        save_bytes_to_disk(response.content, f"{output_dir}/{current_month[0]}.png")
+
+    if failed_months:
+        # The downloaded months are already saved, so running again only fetches the failed ones
+        raise DownloadFailedException(f"Failed to download images for months {failed_months}")
 
     print("All images downloaded and saved to disk")
 
-def crop_and_process_images(input_dir, output_dir, tile_size=(256,256), brightness_factor=BRIGHTNESS_FACTOR, gamma=GAMMA):
+def build_lut(brightness_factor=BRIGHTNESS_FACTOR, gamma=GAMMA):
+    """
+    Build a lookup table applying the brightness factor followed by gamma correction
+    :param brightness_factor: factor to multiply the pixel values by
+    :param gamma: gamma of the correction
+    :return: lookup table of 256 uint8 values
+    """
+    # Match ImageEnhance.Brightness, which multiplies in float32 and truncates to whole uint8 levels
+    values = np.arange(256, dtype=np.float32) * np.float32(brightness_factor)
+    values = np.floor(np.clip(values, 0, 255)).astype(np.float64)
+    if gamma != 1.0:
+        values = ((values / 255.0) ** (1.0 / gamma)) * 255
+    return np.round(values).astype(np.uint8)
+
+def save_tiled_tiff(tiles, shape, output_path, tile_size=(256,256)):
+    """
+    Save an image to disk as a single tiled TIFF, each tile is stored as an internal block
+    :param tiles: iterable of RGB tile arrays in row-major order, so the full image is never held in memory
+    :param shape: shape of the full image as (height, width, 3), a multiple of tile_size
+    :param output_path: path to save the image
+    :param tile_size: size of the tiles as (width, height)
+    """
+    # tifffile is only needed for this output format, so import it lazily
+    import tifffile
+
+    try:
+        tifffile.imwrite(
+            output_path,
+            tiles,
+            shape=shape,
+            dtype=np.uint8,
+            photometric='rgb',
+            tile=(tile_size[1], tile_size[0]),
+            compression='zlib',
+        )
+    except Exception:
+        # Do not leave a partially written file behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    print(f"Image saved to {output_path}")
+
+def check_tiled_tiff_support(tile_size):
+    """
+    Check that tiled TIFFs can be saved with the given tile size
+    :param tile_size: size of the tiles as (width, height)
+    :raises ValueError: if the tile size is not a multiple of 16
+    :raises ImportError: if tifffile is not installed
+    """
+    if tile_size[0] % 16 or tile_size[1] % 16:
+        raise ValueError(f"TIFF tile sizes must be multiples of 16, got {tile_size}")
+    if importlib.util.find_spec("tifffile") is None:
+        raise ImportError("Saving tiled TIFFs requires tifffile, install it with `pip install tifffile`")
+
+def crop_and_process_images(input_dir, output_dir, tile_size=(256,256), brightness_factor=BRIGHTNESS_FACTOR, gamma=GAMMA, tiled_tiff=False):
     """
     Crop and normalize the images to the given size
 
     :param input_dir: directory containing the images
     :param output_dir: directory to save the processed images
     :param size: size of the cropped images
+    :param tiled_tiff: save one tiled TIFF per image instead of one PNG per tile
     """
 
+    # Fail once upfront instead of once per image
+    if tiled_tiff:
+        check_tiled_tiff_support(tile_size)
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff')):
-            img_path = os.path.join(input_dir, filename)
-            try:
-                with Image.open(img_path).convert('RGB') as img:
-                    width, height = img.size
-                    tiles_x = width // tile_size[0]
-                    tiles_y = height // tile_size[1]
-
-                    for i in range(tiles_y):
-                        for j in range(tiles_x):
-                            left = j * tile_size[0]
-                            upper = i * tile_size[1]
-                            right = left + tile_size[0]
-                            lower = upper + tile_size[1]
-
-                            # Crop the sub-image
-                            tile = img.crop((left, upper, right, lower))
-
-                            # Enhance brightness
-                            enhancer = ImageEnhance.Brightness(tile)
-                            tile_bright = enhancer.enhance(brightness_factor)
-
-                            if gamma != 1.0:
-                                inv_gamma = 1.0 / gamma
-                                # Create a lookup table for gamma correction
-                                table = [((c / 255.0) ** inv_gamma) * 255 for c in range(256)]
-                                # Since the image is RGB, replicate the table for each channel
-                                gamma_table = table * 3
-                                tile_bright = tile_bright.point(gamma_table)
-
-                            # Save the processed tile
-                            tile_filename = f"{os.path.splitext(filename)[0]}_tile_{i}_{j}.png"
-                            tile_save_path = os.path.join(output_dir, tile_filename)
-                            tile_bright.save(tile_save_path)
+    # Brightness and gamma are both per-pixel, so apply them in a single pass
+    lut = build_lut(brightness_factor, gamma)
+    tile_w, tile_h = tile_size
 
+    def save_tiles():
+        while True:
+            item = tile_queue.get()
+            if item is None:
+                return
+            tile, tile_save_path = item
+            try:
+                # A low compression level trades a slightly larger file for much faster encoding
+                Image.fromarray(tile).save(tile_save_path, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+            except Exception as e:
+                print(f"Error saving {tile_save_path}: {e}")
+
+    def process_image(filename, img_path):
+        # The image array is local, so it is released before the next image is decoded
+        with Image.open(img_path).convert('RGB') as img:
+            arr = np.asarray(img)
+
+        height, width = arr.shape[:2]
+        tiles_x = width // tile_w
+        tiles_y = height // tile_h
+
+        # Images smaller than a single tile produce no output
+        if tiles_x == 0 or tiles_y == 0:
+            return
+
+        def iter_tiles():
+            # Process the image in blocks of whole tile rows so the lookup and tiling of a
+            # block work on data that is still in cache, instead of passing over the full image
+            for block_start in range(0, tiles_y, TILE_ROWS_PER_BLOCK):
+                block_rows = min(TILE_ROWS_PER_BLOCK, tiles_y - block_start)
+                upper = block_start * tile_h
+
+                # Enhance brightness and apply gamma correction
+                block = lut[arr[upper:upper + block_rows * tile_h, :tiles_x * tile_w]]
+
+                # View the block as a (block_rows, tiles_x, tile_h, tile_w, 3) grid without copying
+                tiles = block.reshape(block_rows, tile_h, tiles_x, tile_w, 3).swapaxes(1, 2)
+
+                for i in range(block_rows):
+                    for j in range(tiles_x):
+                        yield block_start + i, j, tiles[i, j]
+
+        if tiled_tiff:
+            shape = (tiles_y * tile_h, tiles_x * tile_w, 3)
+            tiff_path = os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.tif")
+            save_tiled_tiff((tile for _, _, tile in iter_tiles()), shape, tiff_path, tile_size)
+            return
+
+        for i, j, tile in iter_tiles():
+            # Save the processed tile, copied so the queue does not keep the whole block alive
+            tile_filename = f"{os.path.splitext(filename)[0]}_tile_{i}_{j}.png"
+            tile_save_path = os.path.join(output_dir, tile_filename)
+            tile_queue.put((tile.copy(), tile_save_path))
+
+    # scandir entries carry the path and file type from the directory listing
+    with os.scandir(input_dir) as it:
+        entries = [entry for entry in it if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)]
+
+    def process_images():
+        for entry in entries:
+            try:
+                process_image(entry.name, entry.path)
             except Exception as e:
-                print(f"Error processing {img_path}: {e}")
+                print(f"Error processing {entry.path}: {e}")
+
+    if tiled_tiff:
+        process_images()
+    else:
+        # Tiles are copied out of the current block and handed from the reading thread to the saving
+        # threads through a bounded queue. The reader blocks when the savers fall behind, so memory stays
+        # around one decoded image (two while it is converted to an array), up to two blocks of
+        # TILE_ROWS_PER_BLOCK tile rows, TILE_QUEUE_SIZE queued tiles and one tile per saving thread
+        tile_queue = queue.Queue(maxsize=TILE_QUEUE_SIZE)
+        num_workers = os.cpu_count() or 1
+
+        # PNG encoding releases the GIL, so tiles are saved in parallel
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for _ in range(num_workers):
+                executor.submit(save_tiles)
+
+            try:
+                process_images()
+            finally:
+                # Tell every saving thread to stop once the queue is drained
+                for _ in range(num_workers):
+                    tile_queue.put(None)
 
     print(f"Processing completed. Processed images are saved in '{output_dir}'.")
 
@@ -189,6 +430,18 @@ def main(args=None):
         help="Download images to the specified path. Default is raw_data/."
     )
 
+    parser.add_argument(
+        '--force', '-f',
+        action='store_true',
+        help="Download images again even if they already exist in the download path."
+    )
+
+    parser.add_argument(
+        '--tiff', '-t',
+        action='store_true',
+        help="Save each processed image as a single tiled TIFF instead of one PNG per tile."
+    )
+
     parser.add_argument(
         '--process', '-p',
         nargs='*',
@@ -198,8 +451,6 @@ def main(args=None):
 
     args = parser.parse_args()
 
-    cfg = load_cfg_file(args.config)
-
     # Check if neither download nor process is specified
     if args.download is None and args.process is None:
         # Perform both download and process with default paths
@@ -207,20 +458,22 @@ def main(args=None):
         download_images_to_disk(
             KAISHA_ISLAND_BOUNDING_BOX,
             KAISHA_SIZE,
-            cfg,
+            load_cfg_file(args.config),
             EVALSCRIPT_TRUE_COLOR,
-            output_dir=download_output_dir
+            output_dir=download_output_dir,
+            force=args.force
         )
-        crop_and_process_images(RAW_DATA_FOLDER, PROCESSED_DATA_FOLDER_256)
+        crop_and_process_images(RAW_DATA_FOLDER, PROCESSED_DATA_FOLDER_256, tiled_tiff=args.tiff)
     else:
         if args.download is not None:
             download_output_dir = args.download if isinstance(args.download, str) else RAW_DATA_FOLDER
             download_images_to_disk(
                 KAISHA_ISLAND_BOUNDING_BOX,
                 KAISHA_SIZE,
-                cfg,
+                load_cfg_file(args.config),
                 EVALSCRIPT_TRUE_COLOR,
-                output_dir=download_output_dir
+                output_dir=download_output_dir,
+                force=args.force
             )
 
         if args.process is not None:
@@ -232,7 +485,7 @@ def main(args=None):
             else:  # len(args.process) == 0
                 raw_data_path = RAW_DATA_FOLDER
                 target_path = PROCESSED_DATA_FOLDER_256
-            crop_and_process_images(raw_data_path, target_path)
+            crop_and_process_images(raw_data_path, target_path, tiled_tiff=args.tiff)
 
 
 if __name__=="__main__":